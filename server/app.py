@@ -1,4 +1,5 @@
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import os
 
@@ -6,9 +7,25 @@ from db import init_db
 from routes.images import images_bp
 from routes.conversations import conv_bp
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify/json responses via orjson — same output, C-speed encode."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 def create_app():
     app = Flask(__name__)
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
     CORS(app)
+    # cap upload size so a single multipart request can't balloon worker memory
+    app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_MB", "32")) * 1024 * 1024
     init_db()
     # routes
     app.register_blueprint(images_bp)
@@ -1,11 +1,32 @@
-import os, sqlite3
+import os, sqlite3, threading
 
 BASE = os.path.abspath(os.path.dirname(__file__))
 DB_PATH = os.path.join(BASE, "storage", "app.db")
 
+_local = threading.local()
+
+# Process-wide lock around write transactions: SQLite allows one writer at a
+# time anyway, so queueing threads here (instead of inside SQLite's busy
+# handler) keeps lock contention out of the C layer.
+write_lock = threading.Lock()
+
 def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # Reuse one connection per thread: sqlite3.connect pays file-open and
+    # journal setup each time, which adds up under Flask's threaded server.
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # cached_statements keeps the repeated INSERT/UPDATE pairs compiled
+        # across calls on this connection
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed during writes; NORMAL skips the per-commit
+        # fsync that FULL pays (safe under WAL — a crash loses at most the
+        # last commit, never corrupts); busy_timeout queues writers instead of
+        # failing fast with 'database is locked'
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        _local.conn = conn
     return conn
 
 def init_db():
@@ -13,8 +34,15 @@ def init_db():
         c = conn.cursor()
         c.execute("""CREATE TABLE IF NOT EXISTS images(
             id   INTEGER PRIMARY KEY AUTOINCREMENT,
-            path TEXT NOT NULL
+            path TEXT NOT NULL,
+            sha256 TEXT           -- content digest for dedup; NULL on legacy rows
         )""")
+        # migrate databases created before the sha256 column existed
+        cols = [r["name"] for r in c.execute("PRAGMA table_info(images)")]
+        if "sha256" not in cols:
+            c.execute("ALTER TABLE images ADD COLUMN sha256 TEXT")
+        # unique over non-NULL digests (SQLite allows repeated NULLs)
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_sha256_idx ON images(sha256)")
         c.execute("""CREATE TABLE IF NOT EXISTS conversations(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL DEFAULT 'Untitled',
@@ -28,4 +56,6 @@ def init_db():
             content TEXT NOT NULL,  -- JSON string
             created_at TEXT NOT NULL
         )""")
+        # covers the per-conversation message scans (history reads, edit-index count)
+        c.execute("CREATE INDEX IF NOT EXISTS messages_conv_id_idx ON messages(conversation_id, id)")
         conn.commit()
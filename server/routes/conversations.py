@@ -1,14 +1,21 @@
 from flask import Blueprint, request, jsonify
-from db import db
-from services.storage import save_image_for_conversation, read_path_by_id
+from db import db, write_lock
+from services.storage import save_image_for_conversation, save_filestorage_for_conversation, read_path_by_id
 from services.model import generate_four_edits_from_two_bytes
-from datetime import datetime
-import json, os
+from concurrent.futures import Future
+import hashlib, threading, time
+import jsonutil as json
 
 conv_bp = Blueprint("conversations", __name__)
 
+# single-flight cache: duplicate in-flight edit requests (double-click, client
+# retry) share the first request's result instead of running the model twice
+_inflight: dict[bytes, Future] = {}
+_inflight_lock = threading.Lock()
+
 def now_iso():
-    return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    # time.strftime over gmtime: no datetime object churn per call
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
 @conv_bp.post("/conversations")
 def create_conversation():
@@ -21,20 +28,14 @@ def create_conversation():
     file = request.files.get("image")
     if not file:
         return jsonify({"error":"image required"}), 400
-    img_bytes = file.read()
-    # Create conversation first to obtain cid
-    with db() as conn:
+    # One write transaction: create conversation, stream the base image to its
+    # slot (edit_index=0, never fully buffered), point the conversation at it
+    with write_lock, db() as conn:
         cur = conn.cursor()
         cur.execute("INSERT INTO conversations(title, current_image_id) VALUES (?, 0)", (title,))
         cid = cur.lastrowid
-        conn.commit()
-    # Save the provided base image as originals, edit_index=0
-    img_id, url, _ = save_image_for_conversation(img_bytes, cid, 0, "og")
-    # Update conversation's current image
-    with db() as conn:
-        cur = conn.cursor()
+        img_id, url, _ = save_filestorage_for_conversation(file, cid, 0, "og", conn=conn)
         cur.execute("UPDATE conversations SET current_image_id=? WHERE id=?", (img_id, cid))
-        conn.commit()
     return jsonify({"id": cid, "title": title, "current_image": {"id": img_id, "url": url}})
 
 @conv_bp.post("/conversations/<int:cid>/edits")
@@ -71,55 +72,88 @@ def conversation_edits(cid: int):
         if not conv:
             return jsonify({"error": "conversation not found"}), 404
 
-    # determine edit index from existing user 'edit' messages for this conversation
-    with db() as conn:
-        row = conn.execute("SELECT COUNT(1) AS n FROM messages WHERE conversation_id=? AND kind='edit'", (cid,)).fetchone()
-        edit_index = int(row["n"]) + 1
-
-    # save originals first with naming convention
-    orig_id, _, _ = save_image_for_conversation(orig_bytes, cid, edit_index, "og")
-    mod_id,  _, _ = save_image_for_conversation(mod_bytes,  cid, edit_index, "mod")
-    # Fetch DB-stored paths for logging/response
-    orig_path = read_path_by_id(orig_id)
-    mod_path  = read_path_by_id(mod_id)
-
-    # model returns saved Paths; read bytes and store them
-    paths = generate_four_edits_from_two_bytes(mod_bytes, orig_bytes, prompt)
-    outputs = []
-    for p in paths:
-        with open(p, "rb") as f:
-            vb = f.read()
-        out_id, _, _ = save_image_for_conversation(vb, cid, edit_index, "out")
-        out_path = read_path_by_id(out_id)
-        outputs.append({"image_id": out_id, "url": out_path})
-        # remove intermediate model file to avoid leftover boxed_*_v*.png
-        try:
-            os.remove(p)
-        except Exception:
-            pass
-
-    # log messages
-    with db() as conn:
-        cur = conn.cursor()
-        cur.execute(
+    def _log_edit_messages(conn, info):
+        conn.cursor().executemany(
             """INSERT INTO messages(conversation_id, role, kind, content, created_at)
-                VALUES (?, 'user', 'edit', ?, ?)""",
-            (cid, json.dumps({
-                "prompt": prompt,
-                "original_image_id": orig_id,
-                "original_url": orig_path,
-                "modified_image_id": mod_id,
-                "modified_url": mod_path,
-            }), now_iso())
+                VALUES (?, ?, ?, ?, ?)""",
+            [
+                (cid, "user", "edit", json.dumps({
+                    "prompt": prompt,
+                    "original_image_id": info["orig_id"],
+                    "original_url": info["orig_path"],
+                    "modified_image_id": info["mod_id"],
+                    "modified_url": info["mod_path"],
+                }), now_iso()),
+                (cid, "assistant", "generation", json.dumps({"outputs": info["outputs"]}), now_iso()),
+            ],
         )
-        cur.execute(
-            """INSERT INTO messages(conversation_id, role, kind, content, created_at)
-                VALUES (?, 'assistant', 'generation', ?, ?)""",
-            (cid, json.dumps({"outputs": outputs}), now_iso())
-        )
-        conn.commit()
 
-    return jsonify({"outputs": outputs})
+    def _run_edit():
+        # transaction 1: edit index + both input images, committed once
+        with write_lock, db() as conn:
+            row = conn.execute("SELECT COUNT(1) AS n FROM messages WHERE conversation_id=? AND kind='edit'", (cid,)).fetchone()
+            edit_index = int(row["n"]) + 1
+            # save originals first with naming convention
+            orig_id, _, _ = save_image_for_conversation(orig_bytes, cid, edit_index, "og", conn=conn)
+            mod_id,  _, _ = save_image_for_conversation(mod_bytes,  cid, edit_index, "mod", conn=conn)
+            # Fetch DB-stored paths for logging/response
+            orig_path = read_path_by_id(orig_id, conn=conn)
+            mod_path  = read_path_by_id(mod_id,  conn=conn)
+
+        # model call happens outside any transaction — never hold the writer
+        # lock across a multi-second network call
+        variants = generate_four_edits_from_two_bytes(mod_bytes, orig_bytes, prompt)
+
+        # transaction 2: output ingestion + both message logs, committed once
+        with write_lock, db() as conn:
+            outputs = []
+            for vb in variants:
+                out_id, _, _ = save_image_for_conversation(vb, cid, edit_index, "out", conn=conn)
+                out_path = read_path_by_id(out_id, conn=conn)
+                outputs.append({"image_id": out_id, "url": out_path})
+            info = {
+                "orig_id": orig_id, "orig_path": orig_path,
+                "mod_id": mod_id, "mod_path": mod_path,
+                "outputs": outputs,
+            }
+            _log_edit_messages(conn, info)
+
+        return info
+
+    # single-flight: identical concurrent requests share one generation
+    h = hashlib.sha256()
+    h.update(str(cid).encode()); h.update(b"\x00")
+    h.update(prompt.encode()); h.update(b"\x00")
+    h.update(hashlib.sha256(orig_bytes).digest())
+    h.update(hashlib.sha256(mod_bytes).digest())
+    key = h.digest()
+
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        leader = fut is None
+        if leader:
+            fut = Future()
+            _inflight[key] = fut
+
+    if not leader:
+        # outputs are shared, but every request still leaves its own
+        # message pair in the conversation history
+        shared = fut.result()
+        with write_lock, db() as conn:
+            _log_edit_messages(conn, shared)
+        return jsonify({"outputs": shared["outputs"]})
+
+    try:
+        info = _run_edit()
+        fut.set_result(info)
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+    return jsonify({"outputs": info["outputs"]})
 
 @conv_bp.post("/conversations/<int:cid>/select")
 def select_variant(cid: int):
@@ -127,7 +161,7 @@ def select_variant(cid: int):
     sel_id = data.get("selected_image_id")
     # allow deselect: if null/None/0/"" -> log deselection, do not change current image
     if not sel_id:
-        with db() as conn:
+        with write_lock, db() as conn:
             cur = conn.cursor()
             # verify conversation exists
             row = cur.execute("SELECT id, current_image_id FROM conversations WHERE id=?", (cid,)).fetchone()
@@ -146,13 +180,20 @@ def select_variant(cid: int):
         sel_int = int(sel_id)
     except Exception:
         return jsonify({"error": "selected_image_id must be an integer"}), 400
-    if not read_path_by_id(sel_int):
-        return jsonify({"error":"image not found"}), 404
-    with db() as conn:
+    with write_lock, db() as conn:
         cur = conn.cursor()
-        cur.execute("UPDATE conversations SET current_image_id=? WHERE id=?", (sel_int, cid))
+        # image existence folded into the UPDATE — one statement instead of a
+        # separate read_path_by_id pre-check query
+        cur.execute(
+            """UPDATE conversations SET current_image_id=?
+                   WHERE id=? AND EXISTS(SELECT 1 FROM images WHERE id=?)""",
+            (sel_int, cid, sel_int),
+        )
         if cur.rowcount == 0:
-            return jsonify({"error":"conversation not found"}), 404
+            # disambiguate only on the failure path
+            if not cur.execute("SELECT 1 FROM conversations WHERE id=?", (cid,)).fetchone():
+                return jsonify({"error":"conversation not found"}), 404
+            return jsonify({"error":"image not found"}), 404
         # track message
         cur.execute(
             """INSERT INTO messages(conversation_id, role, kind, content, created_at)
@@ -170,21 +211,38 @@ def select_variant(cid: int):
 # -------------------------------------------------------------------------------------------------
 @conv_bp.get("/conversations")
 def list_conversations():
+    # paginated: newest first, ?before_id=<id> walks older pages
+    limit = min(request.args.get("limit", default=50, type=int), 200)
+    before_id = request.args.get("before_id", type=int)
     with db() as conn:
-        rows = conn.execute("SELECT id, title FROM conversations ORDER BY id DESC").fetchall()
+        if before_id:
+            rows = conn.execute("SELECT id, title FROM conversations WHERE id<? ORDER BY id DESC LIMIT ?", (before_id, limit)).fetchall()
+        else:
+            rows = conn.execute("SELECT id, title FROM conversations ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
     return jsonify([{"id": r["id"], "title": r["title"]} for r in rows])
 
 @conv_bp.get("/conversations/<int:cid>")
 def get_conversation(cid: int):
+    # newest page of messages by default; ?before_id=<message id> pages back
+    limit = min(request.args.get("limit", default=100, type=int), 500)
+    before_id = request.args.get("before_id", type=int)
     with db() as conn:
         conv = conn.execute("SELECT id, title, current_image_id FROM conversations WHERE id=?", (cid,)).fetchone()
         if not conv:
             return jsonify({"error":"not found"}), 404
-        msgs = conn.execute("SELECT role, kind, content, created_at FROM messages WHERE conversation_id=? ORDER BY id ASC", (cid,)).fetchall()
+        if before_id:
+            msgs = conn.execute(
+                "SELECT id, role, kind, content, created_at FROM messages WHERE conversation_id=? AND id<? ORDER BY id DESC LIMIT ?",
+                (cid, before_id, limit)).fetchall()
+        else:
+            msgs = conn.execute(
+                "SELECT id, role, kind, content, created_at FROM messages WHERE conversation_id=? ORDER BY id DESC LIMIT ?",
+                (cid, limit)).fetchall()
     # build current image url
     path = read_path_by_id(conv["current_image_id"])
     current = {"id": conv["current_image_id"], "url": f"/images/{conv['current_image_id']}"} if path else None
-    messages = [{"role": m["role"], "kind": m["kind"], "content": json.loads(m["content"]), "created_at": m["created_at"]} for m in msgs]
+    # rows were fetched newest-first for the LIMIT; present them ascending
+    messages = [{"id": m["id"], "role": m["role"], "kind": m["kind"], "content": json.loads(m["content"]), "created_at": m["created_at"]} for m in reversed(msgs)]
     return jsonify({"id": conv["id"], "title": conv["title"], "current_image": current, "messages": messages})
 
 @conv_bp.put("/conversations/<int:cid>")
@@ -193,7 +251,7 @@ def update_conversation(cid: int):
     title = data.get("title")
     if not title:
         return jsonify({"error":"title required"}), 400
-    with db() as conn:
+    with write_lock, db() as conn:
         cur = conn.cursor()
         cur.execute("UPDATE conversations SET title=? WHERE id=?", (title, cid))
         if cur.rowcount == 0:
@@ -1,9 +1,16 @@
-from flask import Blueprint, jsonify, send_file, send_from_directory, abort
+from flask import Blueprint, Response, jsonify, send_file, send_from_directory, abort
 import os
 from services.storage import read_path_by_id
 
 images_bp = Blueprint("images", __name__)
 
+# With USE_X_ACCEL=1 a fronting nginx serves the file bytes via
+# X-Accel-Redirect (kernel sendfile) and the Flask worker only resolves the id
+USE_X_ACCEL = os.environ.get("USE_X_ACCEL") == "1"
+
+# stored images never change for a given id, so clients can cache forever
+_IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
 @images_bp.get("/images/<int:image_id>")
 def get_image(image_id: int):
     path = read_path_by_id(image_id)
@@ -16,7 +23,15 @@ def get_image(image_id: int):
         abs_path = os.path.join(project_root, path)
     if not os.path.exists(abs_path):
         return jsonify({"error": "not found"}), 404
-    return send_file(abs_path, mimetype="image/png", as_attachment=False)
+    if USE_X_ACCEL:
+        resp = Response(mimetype="image/png")
+        resp.headers["X-Accel-Redirect"] = "/" + path.replace(os.sep, "/")
+    else:
+        # conditional send: revalidations answer 304 off the stable ETag
+        resp = send_file(abs_path, mimetype="image/png", as_attachment=False,
+                         conditional=True, etag=str(image_id))
+    resp.headers["Cache-Control"] = _IMMUTABLE_CACHE
+    return resp
 
 BASE = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 STORAGE_DIR = os.path.join(BASE, "storage")  # <root>/server/storage
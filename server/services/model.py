@@ -1,9 +1,12 @@
 from pathlib import Path
 from io import BytesIO
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional, Union, List, Tuple
-import mimetypes, os, time, uuid, threading
+import asyncio, logging, mimetypes, os, queue, random, threading, time, uuid
+from functools import lru_cache
+from sys import intern
+from types import MappingProxyType
+from logging.handlers import QueueHandler, QueueListener
 
 # pip install google-genai pillow python-dotenv
 from google import genai
@@ -12,11 +15,23 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-# ---------- small thread-safe logger ----------
-_print_lock = threading.Lock()
+# ---------- non-blocking logger ----------
+# Hot-path log() calls only enqueue the record; a single QueueListener
+# thread does the actual stream write, so variant workers never block on
+# stdout I/O.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_logger = logging.getLogger("services.model")
+if not _logger.handlers:
+    # MODEL_LOG_LEVEL=DEBUG turns on the per-variant trace lines below;
+    # unknown values fall back to INFO
+    _logger.setLevel(getattr(logging, os.environ.get("MODEL_LOG_LEVEL", "INFO").upper(), logging.INFO))
+    _logger.addHandler(QueueHandler(_log_queue))
+    _logger.propagate = False
+    _log_listener = QueueListener(_log_queue, logging.StreamHandler())
+    _log_listener.start()
+
 def log(msg: str) -> None:
-    with _print_lock:
-        print(msg, flush=True)
+    _logger.info(msg)
 
 # ---------- prompt ----------
 TEMPLATE = """TASK
@@ -53,17 +68,57 @@ OUTPUT
 • Return the edited IMAGE only (the edited BOXED image) — no overlays, no captions, no borders, no boxes.
 """
 
+# ---------- shared event loop ----------
+# The shared client's httpx pool binds its keep-alive connections to the loop
+# that created them, so all requests must drive it from ONE persistent loop —
+# a per-request asyncio.run() would close the loop and leave the pool holding
+# dead connections ("Event loop is closed" on the next request).
+_loop_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="gemini-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+# ---------- shared client ----------
+# Client construction parses creds and builds an HTTP session — hundreds of ms
+# we don't want on every request. Built lazily (not at import) so the server
+# still starts without GEMINI_API_KEY set.
+_client_lock = threading.Lock()
+_default_client: Optional[genai.Client] = None
+
+def _get_client(api_key: Optional[str] = None) -> genai.Client:
+    global _default_client
+    if api_key:
+        return genai.Client(api_key=api_key)
+    if _default_client is None:
+        with _client_lock:
+            if _default_client is None:
+                _default_client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return _default_client
+
 # ---------- helpers ----------
-_FORMAT_TO_MIME = {
-    "PNG":  "image/png",
-    "JPEG": "image/jpeg",
-    "JPG":  "image/jpeg",
+# read-only lookup tables (MappingProxyType keeps accidental mutation from
+# invalidating CPython's dict-version inline caches); common MIME strings are
+# interned so hot-path fallbacks hand back the shared objects
+_PNG_MIME  = intern("image/png")
+_JPEG_MIME = intern("image/jpeg")
+_FORMAT_TO_MIME = MappingProxyType({
+    "PNG":  _PNG_MIME,
+    "JPEG": _JPEG_MIME,
+    "JPG":  _JPEG_MIME,
     "WEBP": "image/webp",
     "BMP":  "image/bmp",
     "TIFF": "image/tiff",
     "TIF":  "image/tiff",
-}
-_FORMAT_TO_SUFFIX = {
+})
+_FORMAT_TO_SUFFIX = MappingProxyType({
     "PNG":  ".png",
     "JPEG": ".jpg",
     "JPG":  ".jpg",
@@ -71,23 +126,71 @@ _FORMAT_TO_SUFFIX = {
     "BMP":  ".bmp",
     "TIFF": ".tiff",
     "TIF":  ".tiff",
-}
+})
+_SUFFIX_TO_FORMAT = MappingProxyType({
+    ".png":  "PNG",
+    ".jpg":  "JPEG",
+    ".jpeg": "JPEG",
+    ".webp": "WEBP",
+    ".bmp":  "BMP",
+    ".tiff": "TIFF",
+    ".tif":  "TIFF",
+})
+_MIME_TO_SUFFIXES = MappingProxyType({
+    _PNG_MIME:    (".png",),
+    _JPEG_MIME:   (".jpg", ".jpeg"),
+    "image/webp": (".webp",),
+    "image/bmp":  (".bmp",),
+    "image/tiff": (".tiff", ".tif"),
+})
+
+@lru_cache(maxsize=128)
+def _directive_template(global_str: str) -> str:
+    """TEMPLATE with the global directive substituted; cached because all four
+    variants of a request (and retried requests) share the same directive."""
+    g = (global_str or "").strip()
+    return TEMPLATE.replace("{GLOBAL_DIRECTIVE}", g if g else "NONE")
 
 def _build_prompt(global_str: str, variant_idx: int) -> str:
-    g = (global_str or "").strip()
-    return TEMPLATE.replace("{GLOBAL_DIRECTIVE}", g if g else "NONE").replace("{VAR}", str(variant_idx))
+    return _directive_template(global_str).replace("{VAR}", str(variant_idx))
+
+# magic numbers for the formats we care about — all within the first 12 bytes
+_SNIFF = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff",      "JPEG"),
+    (b"RIFF",              "WEBP"),
+    (b"BM",                "BMP"),
+    (b"II*\x00",           "TIFF"),
+    (b"MM\x00*",           "TIFF"),
+)
+
+def _sniff_format(photo_bytes: bytes) -> Optional[str]:
+    head = photo_bytes[:12]
+    for magic, fmt in _SNIFF:
+        if head.startswith(magic):
+            if fmt == "WEBP" and head[8:12] != b"WEBP":
+                continue
+            return fmt
+    return None
 
 def _infer_mime_and_suffix_from_bytes(photo_bytes: bytes, filename_hint: Optional[str]) -> Tuple[str, str]:
     mime_hint = suffix_hint = None
     if filename_hint:
         mime_hint, _ = mimetypes.guess_type(filename_hint)
         suffix_hint = Path(filename_hint).suffix.lower() or None
-    with Image.open(BytesIO(photo_bytes)) as im:
-        fmt = (im.format or "").upper()
-    mime_pil   = _FORMAT_TO_MIME.get(fmt)
-    suffix_pil = _FORMAT_TO_SUFFIX.get(fmt)
-    mime   = mime_hint or mime_pil or "image/png"
-    suffix = suffix_hint or suffix_pil or ".png"
+        # a hint that resolves both answers makes the payload inspection moot
+        if mime_hint and suffix_hint:
+            return mime_hint, suffix_hint
+    # cheap magic-byte sniff first; only fall back to a PIL probe for formats
+    # the sniff table doesn't know
+    fmt = _sniff_format(photo_bytes)
+    if fmt is None:
+        with Image.open(BytesIO(photo_bytes)) as im:
+            fmt = (im.format or "").upper()
+    mime_sniffed   = _FORMAT_TO_MIME.get(fmt)
+    suffix_sniffed = _FORMAT_TO_SUFFIX.get(fmt)
+    mime   = mime_hint or mime_sniffed or _PNG_MIME
+    suffix = suffix_hint or suffix_sniffed or ".png"
     return mime, suffix
 
 def _download_file_bytes(client: genai.Client, file_uri: str) -> bytes:
@@ -99,23 +202,24 @@ def _download_file_bytes(client: genai.Client, file_uri: str) -> bytes:
     raise TypeError("files.download() signature not recognized; update google-genai.")
 
 def _extract_image_from_response(resp, client: genai.Client) -> Tuple[Optional[bytes], Optional[str]]:
-    # inline_data
-    for cand in getattr(resp, "candidates", []) or []:
-        parts = getattr(getattr(cand, "content", None), "parts", []) or []
-        for part in parts:
-            if getattr(part, "inline_data", None):
-                data = part.inline_data.data
-                mt = getattr(part.inline_data, "mime_type", None) or "image/png"
-                return data, mt
-    # file_data
+    # single pass over candidates: inline_data wins within a part, file_data
+    # is the fallback (downloading is only needed when the first inline part
+    # never shows up)
+    file_fallback = None
     for cand in getattr(resp, "candidates", []) or []:
         parts = getattr(getattr(cand, "content", None), "parts", []) or []
         for part in parts:
+            inline = getattr(part, "inline_data", None)
+            if inline:
+                mt = getattr(inline, "mime_type", None) or _PNG_MIME
+                return inline.data, mt
             fd = getattr(part, "file_data", None)
-            if fd and getattr(fd, "file_uri", None):
-                data = _download_file_bytes(client, fd.file_uri)
-                mt = getattr(fd, "mime_type", None) or "image/png"
-                return data, mt
+            if file_fallback is None and fd and getattr(fd, "file_uri", None):
+                file_fallback = fd
+    if file_fallback is not None:
+        data = _download_file_bytes(client, file_fallback.file_uri)
+        mt = getattr(file_fallback, "mime_type", None) or _PNG_MIME
+        return data, mt
     return None, None
 
 # ---------- main (two-image, bytes API) ----------
@@ -126,53 +230,49 @@ def generate_four_edits_from_two_bytes(
     *,
     boxed_filename_hint: Optional[str] = None,   # e.g., "scene_with_boxes.png"
     base_filename_hint: Optional[str] = None,    # e.g., "scene_base.png"
-    outputs_dir: Union[str, Path] = "server/storage/outputs",
     model_name: str = "gemini-2.5-flash-image-preview",
     temperature: float = 0.4,
-    max_workers: int = 4,
     api_key: Optional[str] = None,
     client: Optional[genai.Client] = None,
-) -> List[Path]:
+) -> List[bytes]:
     """
     Generate FOUR edited variants using TWO input images:
       - BASE (no boxes): context only
       - BOXED (with boxes): the image to edit
-    Saves outputs to outputs_dir and returns list of Paths.
+    Returns the variants as encoded image bytes (callers decide persistence).
     """
     total_t0 = time.perf_counter()
-    _client: genai.Client = client or genai.Client(api_key=api_key or os.getenv("GEMINI_API_KEY"))
+    _client: genai.Client = client or _get_client(api_key)
 
     # Infer formats; output naming is based on the BOXED image
     boxed_mime, boxed_suffix = _infer_mime_and_suffix_from_bytes(boxed_bytes, boxed_filename_hint)
     base_mime,  _            = _infer_mime_and_suffix_from_bytes(base_bytes,  base_filename_hint)
 
-    boxed_kb = len(boxed_bytes) / 1024.0
-    base_kb  = len(base_bytes)  / 1024.0
-
     base_stem  = Path(base_filename_hint).stem  if base_filename_hint  else "base"
     boxed_stem = Path(boxed_filename_hint).stem if boxed_filename_hint else "boxed"
     run_stem   = f"{boxed_stem}_{uuid.uuid4().hex[:8]}"
 
-    outputs_dir = Path(outputs_dir); outputs_dir.mkdir(parents=True, exist_ok=True)
-
     # Create reusable inline Parts (order matters for our prompt references)
     part_base  = types.Part.from_bytes(data=base_bytes,  mime_type=base_mime)
     part_boxed = types.Part.from_bytes(data=boxed_bytes, mime_type=boxed_mime)
 
-    log(f"[{run_stem}] INPUTS: BASE={base_kb:.1f} KB ({base_mime}), BOXED={boxed_kb:.1f} KB ({boxed_mime})")
+    # lazy %-style args everywhere below: when the level is INFO, a debug call
+    # costs one level check instead of an f-string render
+    _logger.debug("[%s] INPUTS: BASE=%.1f KB (%s), BOXED=%.1f KB (%s)",
+                  run_stem, len(base_bytes) / 1024.0, base_mime, len(boxed_bytes) / 1024.0, boxed_mime)
 
-    def _one_variant(i: int) -> Path:
+    async def _one_variant(i: int) -> bytes:
         prompt = _build_prompt(global_directive, i)
-        out_path = outputs_dir / f"{run_stem}_v{i}{boxed_suffix}"
 
         backoff = 1.0
         last_err: Optional[Exception] = None
         for attempt in range(1, 5):
             try:
                 call_t0 = time.perf_counter()
-                log(f"[{run_stem} v{i}] CALL attempt {attempt} → model={model_name}, temp={temperature}")
+                _logger.debug("[%s v%d] CALL attempt %d → model=%s, temp=%s",
+                              run_stem, i, attempt, model_name, temperature)
                 # Order: prompt, BASE (context), BOXED (target)
-                resp = _client.models.generate_content(
+                resp = await _client.aio.models.generate_content(
                     model=model_name,
                     contents=[prompt, part_base, part_boxed],
                     config=types.GenerateContentConfig(
@@ -180,41 +280,65 @@ def generate_four_edits_from_two_bytes(
                         temperature=temperature,
                     ),
                 )
-                call_dt = time.perf_counter() - call_t0
-                log(f"[{run_stem} v{i}] RECV ← {call_dt:.2f}s")
+                # the elapsed-time math exists only for this line, so gate it
+                # on the level rather than computing it to be thrown away
+                if _logger.isEnabledFor(logging.DEBUG):
+                    _logger.debug("[%s v%d] RECV ← %.2fs", run_stem, i, time.perf_counter() - call_t0)
 
-                img_bytes, _ = _extract_image_from_response(resp, _client)
+                img_bytes, img_mime = _extract_image_from_response(resp, _client)
                 if not img_bytes:
                     raise RuntimeError("No image bytes returned (safety/decoding).")
 
-                Image.open(BytesIO(img_bytes)).save(out_path)
-                log(f"[{run_stem} v{i}] SAVED → {out_path}")
-                return out_path
+                # Validate with the magic-byte sniff rather than trusting the
+                # reported MIME; a garbage payload goes back around the retry
+                # loop instead of being stored.
+                fmt = _sniff_format(img_bytes)
+                if fmt is None:
+                    raise RuntimeError(f"Unrecognized image payload (mime={img_mime}).")
+                # Pass the bytes through when the actual format already matches
+                # the target suffix; only transcode via PIL on mismatch.
+                if boxed_suffix not in _MIME_TO_SUFFIXES.get(_FORMAT_TO_MIME.get(fmt), ()):
+                    buf = BytesIO()
+                    Image.open(BytesIO(img_bytes)).save(buf, format=_SUFFIX_TO_FORMAT.get(boxed_suffix, "PNG"))
+                    img_bytes = buf.getvalue()
+                _logger.debug("[%s v%d] DONE (%.1f KB)", run_stem, i, len(img_bytes) / 1024.0)
+                return img_bytes
 
             except Exception as e:
                 last_err = e
-                log(f"[{run_stem} v{i}] RETRY {attempt} error: {e}")
-                time.sleep(backoff)
+                _logger.warning("[%s v%d] RETRY %d error: %s", run_stem, i, attempt, e)
+                # full jitter so concurrent variants don't retry in lockstep
+                await asyncio.sleep(random.uniform(0.0, backoff))
                 backoff = min(backoff * 2, 8.0)
 
         raise RuntimeError(f"Variant {i} failed after retries: {last_err}")
 
-    # Run 4 variants in parallel
-    saved: List[Path] = []
-    with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = [ex.submit(_one_variant, i) for i in range(1, 5)]
-        for fut in as_completed(futures):
-            try:
-                saved.append(fut.result())
-            except Exception as e:
-                log(f"[{run_stem}] [WARN] {boxed_filename_hint or 'boxed'}: {e}")
+    # Run 4 variants concurrently on the shared background loop (network-bound,
+    # so coroutines beat a thread pool: no per-call OS thread, shared HTTP pool)
+    async def _gather_variants() -> List[bytes]:
+        # gather preserves submission order, so callers always see v1..v4
+        # (as_completed returned them in finish order, which leaked into the
+        # stored output sequence)
+        results = await asyncio.gather(*(_one_variant(i) for i in range(1, 5)), return_exceptions=True)
+        done: List[bytes] = []
+        for i, res in enumerate(results, start=1):
+            if isinstance(res, BaseException):
+                _logger.warning("[%s] [WARN] v%d %s: %s", run_stem, i, boxed_filename_hint or "boxed", res)
+            else:
+                done.append(res)
+        return done
+
+    # submit to the persistent loop thread; request threads just block on the
+    # result, and concurrent requests share the same loop (httpx pools are not
+    # multi-loop safe)
+    saved: List[bytes] = asyncio.run_coroutine_threadsafe(_gather_variants(), _get_loop()).result()
 
     total_dt = time.perf_counter() - total_t0
     log(f"[{run_stem}] SUMMARY: {len(saved)}/4 variant(s) in {total_dt:.2f}s")
 
     if not saved:
         raise RuntimeError("All variants failed.")
-    return sorted(saved)
+    return saved
 
 # ---------- convenience wrapper: open two files then call bytes-API ----------
 def generate_four_edits_from_files(
@@ -222,10 +346,10 @@ def generate_four_edits_from_files(
     base_image_path:  Union[str, Path],   # path to the BASE (no boxes) image
     global_directive: str,
     **kwargs,
-) -> List[Path]:
+) -> List[bytes]:
     """
     Wrapper that reads two image files, then calls generate_four_edits_from_two_bytes().
-    kwargs are forwarded (outputs_dir, model_name, temperature, etc.).
+    kwargs are forwarded (model_name, temperature, etc.).
     """
     boxed_path = Path(boxed_image_path)
     base_path  = Path(base_image_path)
@@ -249,13 +373,16 @@ def generate_four_edits_from_files(
         **kwargs,
     )
 
-# EXAMPLE USAGE:
-# paths = generate_four_edits_from_files(
-#     boxed_image_path="server/storage/images/2.png",
-#     base_image_path="originals/2.png",
-#     global_directive="Change the weather from summer to winter",
-#     outputs_dir="server/storage/outputs",
-# )
-# print("\nSaved files:")
-# for p in paths:
-#     print(" -", p)
\ No newline at end of file
+# Example run, guarded so importing this module never triggers a generation.
+if __name__ == "__main__":
+    variants = generate_four_edits_from_files(
+        boxed_image_path="server/storage/images/2.png",
+        base_image_path="originals/2.png",
+        global_directive="Change the weather from summer to winter",
+    )
+    out_dir = Path("server/storage/outputs"); out_dir.mkdir(parents=True, exist_ok=True)
+    print("\nSaved files:")
+    for i, vb in enumerate(variants, start=1):
+        out = out_dir / f"example_v{i}.png"
+        out.write_bytes(vb)
+        print(" -", out)
\ No newline at end of file
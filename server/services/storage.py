@@ -1,7 +1,9 @@
-import os
+import hashlib, os, queue, shutil, threading
+from collections import OrderedDict
 from db import db
 
 BASE = os.path.abspath(os.path.dirname(__file__) + "/..")
+PROJECT_ROOT = os.path.dirname(BASE)
 STORAGE_BASE = os.path.join(BASE, "storage")
 DIR_ORIGINALS = os.path.join(STORAGE_BASE, "originals")
 DIR_MODIFIED  = os.path.join(STORAGE_BASE, "modified")
@@ -11,45 +13,137 @@ os.makedirs(DIR_ORIGINALS, exist_ok=True)
 os.makedirs(DIR_MODIFIED,  exist_ok=True)
 os.makedirs(DIR_OUTPUTS,   exist_ok=True)
 
-def _dir_for_kind(kind: str) -> str:
-    if kind == "og":
-        return DIR_ORIGINALS
-    if kind == "mod":
-        return DIR_MODIFIED
-    if kind == "out":
-        return DIR_OUTPUTS
-    return DIR_OUTPUTS
-
-def reserve_image_id() -> int:
-    with db() as conn:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO images(path) VALUES ('')")
-        image_id = cur.lastrowid
+# kind -> (absolute dir, relative dir name) resolved once at import; unknown
+# kinds land in outputs like the old fallback
+_KIND_TO_DIRS = {
+    "og":  (DIR_ORIGINALS, "originals"),
+    "mod": (DIR_MODIFIED,  "modified"),
+    "out": (DIR_OUTPUTS,   "outputs"),
+}
+
+# Dedicated writer thread: image writes are queued so request threads can
+# overlap hashing/SQL with disk I/O, but each enqueuer waits on a per-item
+# completion event (and re-raises writer failures) before its DB row is
+# written — a committed path/sha256 must never reference bytes that aren't
+# on disk yet, or a failed write.
+_write_queue: "queue.Queue[tuple[str, bytes, threading.Event, list]]" = queue.Queue()
+
+def _writer_loop():
+    while True:
+        abs_path, img_bytes, done, errs = _write_queue.get()
+        try:
+            # raw os.write: skips Python's buffered-IO layer and its extra
+            # userspace memcpy of the full payload
+            fd = os.open(abs_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, img_bytes)
+            finally:
+                os.close(fd)
+        except Exception as e:
+            errs.append(e)
+        finally:
+            done.set()
+            _write_queue.task_done()
+
+_writer = threading.Thread(target=_writer_loop, name="img-writer", daemon=True)
+_writer.start()
+
+def reserve_image_id(conn=None) -> int:
+    # When a caller passes its own connection the insert joins that
+    # transaction and the caller owns the commit.
+    own = conn is None
+    if own:
+        conn = db()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO images(path) VALUES ('')")
+    image_id = cur.lastrowid
+    if own:
         conn.commit()
     return image_id
 
-def write_reserved_image(image_id: int, conversation_id: int, edit_index: int, kind: str, img_bytes: bytes) -> tuple[int, str, str]:
+def write_reserved_image(image_id: int, conversation_id: int, edit_index: int, kind: str, img_bytes: bytes, conn=None, sha256: str | None = None) -> tuple[int, str, str]:
     """
     Write bytes for an already-reserved image id into server/storage/<kind>/c{cid}_e{edit}_{kind}_id{image_id}.png
     Stores a RELATIVE path starting with "server/storage" in the DB, and returns (id, url, abs_path).
     """
-    kind_dir = _dir_for_kind(kind)
+    kind_dir, rel_dir = _KIND_TO_DIRS.get(kind, _KIND_TO_DIRS["out"])
+    filename = f"c{conversation_id}_e{edit_index}_{kind}_id{image_id}.png"
+    abs_path = os.path.join(kind_dir, filename)
+    rel_path = os.path.join("server", "storage", rel_dir, filename)
+    done = threading.Event()
+    errs: list = []
+    _write_queue.put((abs_path, img_bytes, done, errs))
+    # the bytes must be on disk before the row that names them is written
+    done.wait()
+    if errs:
+        raise errs[0]
+    own = conn is None
+    if own:
+        conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE images SET path=?, sha256=? WHERE id=?", (rel_path, sha256, image_id))
+    if own:
+        conn.commit()
+    return image_id, f"/images/{image_id}", abs_path
+
+def save_image_for_conversation(img_bytes: bytes, conversation_id: int, edit_index: int, kind: str, conn=None) -> tuple[int, str, str]:
+    own = conn is None
+    if own:
+        conn = db()
+    # content-addressed dedup: identical bytes (re-uploaded base image,
+    # idempotent model output) reuse the existing row and file
+    digest = hashlib.sha256(img_bytes).hexdigest()
+    row = conn.execute("SELECT id, path FROM images WHERE sha256=?", (digest,)).fetchone()
+    if row:
+        image_id = row["id"]
+        return image_id, f"/images/{image_id}", os.path.join(PROJECT_ROOT, row["path"])
+    image_id = reserve_image_id(conn=conn)
+    result = write_reserved_image(image_id, conversation_id, edit_index, kind, img_bytes, conn=conn, sha256=digest)
+    if own:
+        conn.commit()
+    return result
+
+def save_filestorage_for_conversation(fs, conversation_id: int, edit_index: int, kind: str, conn=None) -> tuple[int, str, str]:
+    """
+    Stream an uploaded werkzeug FileStorage straight into its storage slot in
+    chunks, so the upload never has to sit fully in memory. Same return
+    contract as save_image_for_conversation.
+    """
+    image_id = reserve_image_id(conn=conn)
+    kind_dir, rel_dir = _KIND_TO_DIRS.get(kind, _KIND_TO_DIRS["out"])
     filename = f"c{conversation_id}_e{edit_index}_{kind}_id{image_id}.png"
     abs_path = os.path.join(kind_dir, filename)
-    rel_path = os.path.join("server", "storage", os.path.basename(kind_dir), filename)
+    rel_path = os.path.join("server", "storage", rel_dir, filename)
     with open(abs_path, "wb") as f:
-        f.write(img_bytes)
-    with db() as conn:
-        cur = conn.cursor()
-        cur.execute("UPDATE images SET path=? WHERE id=?", (rel_path, image_id))
+        shutil.copyfileobj(fs.stream, f, 256 * 1024)
+    own = conn is None
+    if own:
+        conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE images SET path=? WHERE id=?", (rel_path, image_id))
+    if own:
         conn.commit()
     return image_id, f"/images/{image_id}", abs_path
 
-def save_image_for_conversation(img_bytes: bytes, conversation_id: int, edit_index: int, kind: str) -> tuple[int, str, str]:
-    image_id = reserve_image_id()
-    return write_reserved_image(image_id, conversation_id, edit_index, kind, img_bytes)
+# id -> path is immutable once written, so a bounded LRU lets the hot
+# /images/<id> endpoint (and repeat lookups per edit) skip SQLite entirely
+_PATH_CACHE_MAX = 1024
+_path_cache: "OrderedDict[int, str]" = OrderedDict()
+_path_cache_lock = threading.Lock()
 
-def read_path_by_id(image_id: int) -> str | None:
-    with db() as conn:
-        row = conn.execute("SELECT path FROM images WHERE id=?", (image_id,)).fetchone()
-        return row["path"] if row else None
+def read_path_by_id(image_id: int, conn=None) -> str | None:
+    with _path_cache_lock:
+        path = _path_cache.get(image_id)
+        if path is not None:
+            _path_cache.move_to_end(image_id)
+            return path
+    if conn is None:
+        conn = db()
+    row = conn.execute("SELECT path FROM images WHERE id=?", (image_id,)).fetchone()
+    path = row["path"] if row else None
+    if path:  # don't cache misses or still-empty reserved slots
+        with _path_cache_lock:
+            _path_cache[image_id] = path
+            if len(_path_cache) > _PATH_CACHE_MAX:
+                _path_cache.popitem(last=False)
+    return path